@@ -2,93 +2,157 @@
 
 import argparse
 import asyncio
+import concurrent.futures
 import csv
+import itertools
 import logging
 import pathlib
 import re
 import sys
-from collections import defaultdict
-from typing import Dict, List, Tuple
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple
 
 from common import IncludeChange
+from utils import get_worker_count
 
 INCLUDE_REGEX = re.compile(r"\s*#include ([\"<](.*)[\">])")
 
 Change = Tuple[IncludeChange, int, str]
 
 
-# TODO - Refactor this to take filename and list of changes instead of file_changes
+def parse_include_line(line: str) -> Optional[str]:
+    """Returns the included header for a stripped #include line, or None if it isn't one"""
+
+    # Fast path for the common case of a plain include with nothing trailing it, which
+    # is equivalent to the regex match, but avoids the regex engine for every line
+    if len(line) > 10 and line.startswith("#include ") and line[9] in '"<' and line[-1] in '">':
+        include = line[9:]
+    else:
+        include_match = INCLUDE_REGEX.match(line)
+
+        if include_match is None:
+            return None
+
+        include = include_match.group(1)
+
+    return include.strip('"')
+
+
+def apply_file_changes(filename: str, changes: List[Change], save_changes=True):
+    """Apply changes to a file"""
+
+    # Split up the changes by type, sorted by line number so they can be applied in order
+    removes = sorted((change for change in changes if change[0] is IncludeChange.REMOVE), key=lambda x: x[1])
+    adds = sorted((change for change in changes if change[0] is IncludeChange.ADD), key=lambda x: x[1])
+
+    with open(filename, "r") as f:
+        original_lines = f.readlines()
+
+    # Track the include lines present in the file so adds can check for duplicates
+    present_includes = Counter(line.strip() for line in original_lines if line.lstrip().startswith("#include"))
+    lines: List[Optional[str]] = list(original_lines)
+
+    # Removes are applied first, by blanking out the removed lines. Line numbers for
+    # all changes are for the original file, so this doesn't affect the adds.
+    for _, line_number, header in removes:
+        if line_number >= len(lines):
+            logging.warning(f"Skipping removing line {filename}:{line_number}, line doesn't exist")
+            continue
+        elif lines[line_number] is None:
+            logging.warning(f"Skipping removing line {filename}:{line_number}, line already removed")
+            continue
+
+        # Confirm that the line looks as expected before removing
+        current_line = original_lines[line_number].strip()
+        include = parse_include_line(current_line)
+
+        if include is None:
+            logging.warning(
+                f"Skipping removing line {filename}:{line_number}, line doesn't match an include: {current_line}"
+            )
+            continue
+
+        if include != header:
+            logging.warning(f"Skipping removing {filename}:{line_number}, expected: '{header}', found '{include}'")
+            continue
+
+        logging.debug(f"Removed include: {filename}:{line_number}:{current_line}")
+        lines[line_number] = None
+        present_includes[current_line] -= 1
+
+    # Then build the new file contents in a single pass, copying over the original
+    # lines between adds, rather than shifting the lines around for each add
+    new_lines: List[Optional[str]] = []
+    next_line_number = 0
+
+    for _, line_number, header in adds:
+        if header.startswith("<"):
+            include_line = f"#include {header}"
+        else:
+            include_line = f'#include "{header}"'
+
+        if present_includes[include_line] > 0:
+            logging.warning(f"Skipping, include already present: {filename}:{include_line}")
+            continue
+
+        new_lines.extend(lines[next_line_number:line_number])
+        next_line_number = max(next_line_number, line_number)
+
+        logging.debug(f"Added include: {filename}:{line_number}:{include_line}")
+        new_lines.append(f"{include_line}\n")
+        present_includes[include_line] += 1
+
+    new_lines.extend(lines[next_line_number:])
+
+    # Write the content back out to file with modified includes
+    if save_changes:
+        with open(filename, "w") as f:
+            f.writelines(line for line in new_lines if line is not None)
+
+
+def configure_worker_logging(level: Optional[int]):
+    # Worker processes which are spawned rather than forked don't inherit the logging configuration
+    if level is not None:
+        logging.basicConfig(level=level)
+
+
 def apply_changes(root_path: pathlib.Path, file_changes: Dict[str, List[Change]], save_changes=True):
     """Apply changes to files"""
 
     if not save_changes:
         logging.debug("Not saving changes to files")
 
-    for filename, changes in file_changes.items():
-        # Sort the changes by line number so they can be applied in order
-        changes = sorted(changes, key=lambda x: x[1])
-        line_offset = 0
-
-        with open(filename, "r+") as f:
-            lines = f.readlines()
-
-            # Apply the changes and track the line offset as changes are applied
-            for change_type, line_number, header in changes:
-                current_line_number = line_number + line_offset
-
-                if change_type is IncludeChange.REMOVE:
-                    # Confirm that the line looks as expected before removing
-                    current_line = lines[current_line_number].strip()
-                    include_match = INCLUDE_REGEX.match(current_line)
-
-                    if include_match is None:
-                        logging.warning(
-                            f"Skipping removing line {filename}:{current_line_number}, line doesn't match an include: {current_line}"
-                        )
-                        continue
-
-                    include = include_match.group(1).strip('"')
-
-                    if include != header:
-                        logging.warning(
-                            f"Skipping removing {filename}:{current_line_number}, expected: '{header}', found '{include}'"
-                        )
-                        continue
-
-                    logging.debug(f"Removed include: {filename}:{current_line_number}:{current_line}")
-                    del lines[current_line_number]
-                    line_offset -= 1
-                elif change_type is IncludeChange.ADD:
-                    skip = False
-
-                    if header.startswith("<"):
-                        include_line = f"#include {header}"
-                    else:
-                        include_line = f'#include "{header}"'
-
-                    for idx, line in enumerate(lines):
-                        if line.strip() == include_line:
-                            logging.warning(f"Skipping, include already present: {filename}:{idx + 1}:{include_line}")
-                            skip = True
-                            break
-
-                    if not skip:
-                        logging.debug(f"Added include: {filename}:{current_line_number}:{include_line}")
-                        lines.insert(current_line_number, f"{include_line}\n")
-                        line_offset += 1
-
-            # Write the content back out to file with modified includes
-            if save_changes:
-                f.seek(0)
-                f.truncate()
-                f.writelines(lines)
+    # Starting worker processes isn't worth it for a single file
+    if len(file_changes) <= 1:
+        for filename, changes in file_changes.items():
+            apply_file_changes(filename, changes, save_changes)
+        return
+
+    root_logger = logging.getLogger()
+    log_level = root_logger.level if root_logger.handlers else None
+
+    # Each file's changes are independent, so apply them in parallel
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=min(get_worker_count(), len(file_changes)) or 1,
+        initializer=configure_worker_logging,
+        initargs=(log_level,),
+    ) as executor:
+        # Consume the results so that any exceptions from the workers are raised
+        for _ in executor.map(
+            apply_file_changes,
+            file_changes.keys(),
+            file_changes.values(),
+            itertools.repeat(save_changes),
+            chunksize=16,
+        ):
+            pass
 
 
 async def main():
     parser = argparse.ArgumentParser(description="Apply include changes to files in the source tree")
     parser.add_argument(
         "changes_file",
-        type=argparse.FileType("r"),
+        type=argparse.FileType("r", bufsize=1 << 20),
         help="CSV of changes to apply.",
     )
     parser.add_argument(
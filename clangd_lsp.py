@@ -1,20 +1,20 @@
 import asyncio
 import contextlib
 import enum
+import json
 import logging
 import pathlib
 import re
 import subprocess
-from typing import Any, Dict, List, Optional, Tuple, Type
+from typing import Any, Dict, List, Optional, Set, Tuple, Type, Union
 
 import sansio_lsp_client as lsp
 from pydantic import BaseModel, parse_obj_as
-from sansio_lsp_client.io_handler import _make_request, _make_response
-from sansio_lsp_client.structs import JSONDict, Request
+from sansio_lsp_client.structs import JSONDict, JSONList, Request
 
 from utils import get_worker_count
 
-INCLUDE_REGEX = re.compile(r"\s*#\s*include ([\"<](.*)[\">])")
+INCLUDE_REGEX = re.compile(r"\s*#\s*include\s+([\"<]([^\">]*)[\">])")
 
 # TODO - Bit hackish, but add to the LSP capabilities here, only extension point we have
 lsp.client.CAPABILITIES["textDocument"]["publishDiagnostics"]["codeActionsInline"] = True  # type: ignore
@@ -57,24 +57,57 @@ class ClangdPublishDiagnostics(lsp.PublishDiagnostics):
     diagnostics: List[ClangdDiagnostic]
 
 
+# Only Content-Length is required, Content-Type defaults to JSON-RPC with UTF-8
+LSP_MESSAGE_HEADER = b"Content-Length: %d\r\n\r\n"
+
+
+def make_lsp_message(content: JSONDict) -> bytes:
+    encoded_content = json.dumps(content).encode("utf-8")
+
+    return LSP_MESSAGE_HEADER % len(encoded_content) + encoded_content
+
+
+def make_request(method: str, params: Optional[JSONDict] = None, id: Optional[int] = None) -> bytes:
+    content: JSONDict = {"jsonrpc": "2.0", "method": method}
+    if params is not None:
+        content["params"] = params
+    if id is not None:
+        content["id"] = id
+
+    return make_lsp_message(content)
+
+
+def make_response(
+    id: int, result: Optional[Union[JSONDict, JSONList]] = None, error: Optional[JSONDict] = None
+) -> bytes:
+    content: JSONDict = {"jsonrpc": "2.0", "id": id}
+    if result is not None:
+        content["result"] = result
+    if error is not None:
+        content["error"] = error
+
+    return make_lsp_message(content)
+
+
 class AsyncSendLspClient(lsp.Client):
-    def _ensure_send_buf_is_queue(self):
-        if not isinstance(self._send_buf, asyncio.Queue):
-            self._send_buf: asyncio.Queue[bytes] = asyncio.Queue()
+    def __init__(self, *args, **kwargs):
+        # Messages are appended to the base class' send buffer, and this is set
+        # whenever there's something in it, so the sender can wait on it
+        self._send_event = asyncio.Event()
+        super().__init__(*args, **kwargs)
 
     def _send_request(self, method: str, params: Optional[JSONDict] = None) -> int:
-        self._ensure_send_buf_is_queue()
-
         id = self._id_counter
         self._id_counter += 1
 
-        self._send_buf.put_nowait(_make_request(method=method, params=params, id=id))
+        self._send_buf += make_request(method=method, params=params, id=id)
+        self._send_event.set()
         self._unanswered_requests[id] = Request(id=id, method=method, params=params)
         return id
 
     def _send_notification(self, method: str, params: Optional[JSONDict] = None) -> None:
-        self._ensure_send_buf_is_queue()
-        self._send_buf.put_nowait(_make_request(method=method, params=params))
+        self._send_buf += make_request(method=method, params=params)
+        self._send_event.set()
 
     def _send_response(
         self,
@@ -82,8 +115,8 @@ class AsyncSendLspClient(lsp.Client):
         result: Optional[JSONDict] = None,
         error: Optional[JSONDict] = None,
     ) -> None:
-        self._ensure_send_buf_is_queue()
-        self._send_buf.put_nowait(_make_response(id=id, result=result, error=error))
+        self._send_buf += make_response(id=id, result=result, error=error)
+        self._send_event.set()
 
     def _handle_request(self, request: lsp.Request) -> lsp.Event:
         # TODO - This is copied from sansio-lsp-client
@@ -105,19 +138,39 @@ class AsyncSendLspClient(lsp.Client):
         return super()._handle_request(request)
 
     async def async_send(self) -> bytes:
-        return await self._send_buf.get()
+        # Wait for a message, then take everything which is already buffered,
+        # so a burst of messages is written and drained all at once
+        await self._send_event.wait()
+        self._send_event.clear()
+
+        send_buf = bytes(self._send_buf)
+        self._send_buf.clear()
+
+        return send_buf
 
 
 IncludeLine = Tuple[str, int]
 
 
+def read_source_file(path: pathlib.Path) -> str:
+    # clangd expects UTF-8, and decoding the bytes in one go skips the
+    # text I/O layer's incremental decoding and newline translation
+    return path.read_bytes().decode("utf-8")
+
+
 def parse_includes_from_diagnostics(
     filename: str, document: lsp.TextDocumentItem, diagnostics: List[ClangdDiagnostic]
 ) -> Tuple[Tuple[IncludeLine, ...], Tuple[IncludeLine, ...]]:
     """Returns a tuple of (add, remove) includes"""
 
     add_includes: Set[IncludeLine] = set()
-    remove_includes: List[IncludeLine] = []
+    # Keyed by include to drop duplicates while keeping the order of the diagnostics
+    remove_includes: Dict[IncludeLine, None] = {}
+
+    # The document text is only split into lines if there's an unused include
+    # diagnostic, and then only once, rather than for every one of them
+    lines: Optional[List[str]] = None
+    match_include = INCLUDE_REGEX.match
 
     # Parse include diagnostics
     for diagnostic in diagnostics:
@@ -127,12 +180,14 @@ def parse_includes_from_diagnostics(
 
             # Only need the line number, we don't expect multi-line includes
             assert diagnostic.range.start.line == diagnostic.range.end.line
-            text = document.text.splitlines()[diagnostic.range.start.line]
+            if lines is None:
+                lines = document.text.splitlines()
+            text = lines[diagnostic.range.start.line]
 
-            include_match = INCLUDE_REGEX.match(text)
+            include_match = match_include(text)
 
             if include_match:
-                remove_includes.append((include_match.group(2), diagnostic.range.start.line))
+                remove_includes[(include_match.group(2), diagnostic.range.start.line)] = None
             else:
                 logging.error(f"Couldn't match #include regex to diagnostic line: {text}")
         elif diagnostic.code == "missing-includes":
@@ -144,7 +199,7 @@ def parse_includes_from_diagnostics(
 
             textEdit = diagnostic.codeActions[0].edit.changes[document.uri][0]
             text = textEdit.newText
-            include_match = INCLUDE_REGEX.match(text)
+            include_match = match_include(text)
 
             if include_match:
                 # TODO - Alias things like: absl/types/optional.h -> third_party/abseil-cpp/absl/types/optional.h
@@ -155,6 +210,30 @@ def parse_includes_from_diagnostics(
     return (tuple(add_includes), tuple(remove_includes))
 
 
+# Language identifiers for documents, keyed by file extension
+LANGUAGE_IDS = {
+    # TODO - How to mark header files as Objective-C++ or C? Does it matter?
+    ".h": "cpp",
+    ".hh": "cpp",
+    ".hpp": "cpp",
+    ".hpp11": "cpp",
+    ".hxx": "cpp",
+    ".cc": "cpp",
+    ".cpp": "cpp",
+    ".cxx": "cpp",
+    ".c": "c",
+    ".mm": "objective-cpp",
+}
+
+# Server requests which are replied to with the default reply
+DEFAULT_REPLY_MESSAGE_TYPES = (
+    lsp.ShowMessageRequest,
+    lsp.WorkDoneProgressCreate,
+    lsp.RegisterCapabilityRequest,
+    lsp.ConfigurationRequest,
+)
+
+
 # Partially based on sansio-lsp-client/tests/test_actual_langservers.py
 class ClangdClient:
     def __init__(self, clangd_path: str, root_path: pathlib.Path, compile_commands_dir: pathlib.Path = None):
@@ -173,6 +252,16 @@ class ClangdClient:
         self._new_messages = asyncio.Queue()
         self._notification_queues = []
         self._process_gone = asyncio.Event()
+        self._uris: Dict[str, str] = {}
+
+    def _get_uri(self, filename: str) -> str:
+        # The same URI is needed several times for each document, so cache it
+        uri = self._uris.get(filename)
+
+        if uri is None:
+            uri = self._uris[filename] = (self.root_path / filename).as_uri()
+
+        return uri
 
     async def _send_stdin(self):
         try:
@@ -181,8 +270,9 @@ class ClangdClient:
                 self._process.stdin.write(message)
                 await self._process.stdin.drain()
 
-                # Log the sent message for debugging purposes
-                self.logger.debug(message.decode("utf8").rstrip())
+                # Log the sent message for debugging purposes, skipping the decode when not logging
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug(message.decode("utf8").rstrip())
         except asyncio.CancelledError:
             pass
 
@@ -191,7 +281,8 @@ class ClangdClient:
     async def _process_stdout(self):
         try:
             while self._process:
-                data = await self._process.stdout.read(1024)
+                # Diagnostics messages can be large, so read as much as is available at once
+                data = await self._process.stdout.read(65536)
                 if data == b"":  # EOF
                     break
 
@@ -199,8 +290,9 @@ class ClangdClient:
                 for event in self.lsp_client.recv(data):
                     if isinstance(event, lsp.ServerNotification):
                         # If a notification comes in, tell anyone listening
-                        for queue in self._notification_queues:
-                            queue.put_nowait(event)
+                        for notification_filter, queue in self._notification_queues:
+                            if notification_filter is None or notification_filter(event):
+                                queue.put_nowait(event)
                     else:
                         self._new_messages.put_nowait(event)
                         self._try_default_reply(event)
@@ -220,8 +312,9 @@ class ClangdClient:
                 if line == b"":  # EOF
                     break
 
-                # Log the output for debugging purposes
-                self.logger.debug(line.decode("utf8").rstrip())
+                # Log the output for debugging purposes, skipping the decode when not logging
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug(line.decode("utf8").rstrip())
         except asyncio.CancelledError:
             pass
 
@@ -233,39 +326,40 @@ class ClangdClient:
         if self.compile_commands_dir:
             args.append(f"--compile-commands-dir={self.compile_commands_dir}")
 
+        # clangd's stderr is only used for debug logging, so don't bother with it otherwise
+        log_stderr = self.logger.isEnabledFor(logging.DEBUG)
+
+        if not log_stderr:
+            args.append("--log=error")
+
         self._process = await asyncio.create_subprocess_exec(
             self.clangd_path,
             *args,
             cwd=self.root_path,
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
+            stderr=subprocess.PIPE if log_stderr else subprocess.DEVNULL,
         )
 
         # Create concurrently running tasks for sending input to clangd, and for processing clangd's output
-        self._concurrent_tasks = asyncio.gather(
-            self._send_stdin(), self._process_stdout(), self._log_stderr(), return_exceptions=True
-        )
+        tasks = [self._send_stdin(), self._process_stdout()]
+
+        if log_stderr:
+            tasks.append(self._log_stderr())
+
+        self._concurrent_tasks = asyncio.gather(*tasks, return_exceptions=True)
 
         await self._wait_for_message_of_type(lsp.Initialized)
 
     def _try_default_reply(self, msg):
-        if isinstance(
-            msg,
-            (
-                lsp.ShowMessageRequest,
-                lsp.WorkDoneProgressCreate,
-                lsp.RegisterCapabilityRequest,
-                lsp.ConfigurationRequest,
-            ),
-        ):
+        if isinstance(msg, DEFAULT_REPLY_MESSAGE_TYPES):
             msg.reply()
 
     async def _wait_for_message_of_type(self, message_type, timeout=5):
         # First check already processed messages
-        for message in self._messages:
+        for idx, message in enumerate(self._messages):
             if isinstance(message, message_type):
-                self._messages.remove(message)
+                del self._messages[idx]
                 return message
 
         # Then keep waiting for a message of the correct type
@@ -276,78 +370,58 @@ class ClangdClient:
             else:
                 self._messages.append(message)
 
-    async def _wrap_coro(self, coro):
-        process_gone_task = asyncio.create_task(self._process_gone.wait())
-        task = asyncio.create_task(coro)
-        done, _ = await asyncio.wait({task, process_gone_task}, return_when=asyncio.FIRST_COMPLETED)
-
-        if process_gone_task in done:
-            task.cancel()
-            raise ClangdCrashed()
-        else:
-            process_gone_task.cancel()
-
-        return task.result()
-
     @contextlib.asynccontextmanager
-    async def listen_for_notifications(self, cancellation_token=None):
+    async def listen_for_notifications(self, cancellation_token=None, notification_filter=None):
         queue = asyncio.Queue()
+        listener = (notification_filter, queue)
         if cancellation_token is None:
             cancellation_token = asyncio.Event()
 
+        # Wake up the listener with a sentinel value when cancelled or when clangd goes away,
+        # rather than waiting on the cancellation token and the process for every notification
+        process_gone = object()
+        cancellation_token_task = asyncio.create_task(cancellation_token.wait())
+        cancellation_token_task.add_done_callback(lambda _: queue.put_nowait(None))
+        process_gone_task = asyncio.create_task(self._process_gone.wait())
+        process_gone_task.add_done_callback(lambda _: queue.put_nowait(process_gone))
+
         async def get_notifications():
-            cancellation_token_task = asyncio.create_task(cancellation_token.wait())
+            while True:
+                notification = await queue.get()
 
-            try:
-                while not cancellation_token.is_set():
-                    queue_task = asyncio.create_task(self._wrap_coro(queue.get()))
-                    done, _ = await asyncio.wait(
-                        {queue_task, cancellation_token_task}, return_when=asyncio.FIRST_COMPLETED
-                    )
+                if notification is None:
+                    break
+                elif notification is process_gone:
+                    raise ClangdCrashed()
 
-                    if cancellation_token_task in done:
-                        queue_task.cancel()
-                        break
-                    else:
-                        yield queue_task.result()
-            finally:
-                cancellation_token_task.cancel()
+                yield notification
+
+        self._notification_queues.append(listener)
 
-        self._notification_queues.append(queue)
-        yield get_notifications()
-        cancellation_token.set()
-        self._notification_queues.remove(queue)
+        try:
+            yield get_notifications()
+        finally:
+            cancellation_token.set()
+            cancellation_token_task.cancel()
+            process_gone_task.cancel()
+            self._notification_queues.remove(listener)
 
     @staticmethod
     def validate_config(root_path: pathlib.Path):
         # TODO - Check for a valid config with IncludeCleaner setup
         return True
 
-    def open_document(self, filename: str) -> lsp.TextDocumentItem:
-        if filename.endswith(".h"):
-            # TODO - How to mark header files as Objective-C++ or C? Does it matter?
-            language_id = "cpp"
-        elif (
-            filename.endswith(".hh")
-            or filename.endswith(".hpp")
-            or filename.endswith(".hpp11")
-            or filename.endswith(".hxx")
-        ):
-            language_id = "cpp"
-        elif filename.endswith(".cc") or filename.endswith(".cpp") or filename.endswith(".cxx"):
-            language_id = "cpp"
-        elif filename.endswith(".c"):
-            language_id = "c"
-        elif filename.endswith(".mm"):
-            language_id = "objective-cpp"
-        else:
-            raise RuntimeError(f"Unknown file extension: {filename}")
-
-        with open((self.root_path / filename), "r") as f:
-            file_contents = f.read()
+    async def open_document(self, filename: str) -> lsp.TextDocumentItem:
+        try:
+            language_id = LANGUAGE_IDS[pathlib.PurePath(filename).suffix]
+        except KeyError:
+            raise RuntimeError(f"Unknown file extension: {filename}") from None
+
+        # Read the file in a thread so other documents aren't held up waiting on disk I/O
+        file_contents = await asyncio.to_thread(read_source_file, self.root_path / filename)
 
         document = lsp.TextDocumentItem(
-            uri=(self.root_path / filename).as_uri(),
+            uri=self._get_uri(filename),
             languageId=language_id,
             text=file_contents,
             version=1,
@@ -360,18 +434,18 @@ class ClangdClient:
     def close_document(self, filename: str):
         self.lsp_client.did_close(
             lsp.TextDocumentIdentifier(
-                uri=(self.root_path / filename).as_uri(),
+                uri=self._get_uri(filename),
             )
         )
 
     @contextlib.asynccontextmanager
     async def with_document(self, filename: str):
-        yield self.open_document(filename)
+        yield await self.open_document(filename)
         self.close_document(filename)
 
     def change_document(self, filename: str, version: int, text: str, want_diagnostics: Optional[bool] = None):
         text_document = lsp.VersionedTextDocumentIdentifier(
-            uri=(self.root_path / filename).as_uri(),
+            uri=self._get_uri(filename),
             version=version,
         )
         content_changes = [lsp.TextDocumentContentChangeEvent(text=text)]
@@ -395,7 +469,7 @@ class ClangdClient:
     def save_document(self, filename: str):
         self.lsp_client.did_save(
             lsp.TextDocumentIdentifier(
-                uri=(self.root_path / filename).as_uri(),
+                uri=self._get_uri(filename),
             )
         )
 
@@ -405,12 +479,17 @@ class ClangdClient:
         document: lsp.TextDocumentItem
         notification: ClangdPublishDiagnostics
 
-        # Open the document and wait for the diagnostics notification
-        async with self.listen_for_notifications() as notifications:
+        uri = self._get_uri(filename)
+
+        def is_document_diagnostics(notification):
+            return isinstance(notification, ClangdPublishDiagnostics) and notification.uri == uri
+
+        # Open the document and wait for the diagnostics notification, other
+        # notifications are filtered out before they reach the listener
+        async with self.listen_for_notifications(notification_filter=is_document_diagnostics) as notifications:
             async with self.with_document(filename) as document:
                 async for notification in notifications:
-                    if isinstance(notification, ClangdPublishDiagnostics) and notification.uri == document.uri:
-                        break
+                    break
 
         return parse_includes_from_diagnostics(filename, document, notification.diagnostics)
 
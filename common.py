@@ -10,9 +10,11 @@ class IncludeChange(enum.Enum):
 
     @classmethod
     def from_value(cls, value):
-        for enum_value in cls:
-            if enum_value.value == value:
-                return enum_value
+        # The enum's own lookup by value is a dict lookup rather than a linear scan
+        try:
+            return cls(value)
+        except ValueError:
+            return None
 
 
 class IgnoresSubConfiguration(BaseModel):
@@ -36,6 +36,22 @@ def filter_changes(
     # mapping, since we know that means clangd is confused on which header to include
     pending_changes: DefaultDict[str, Dict[str, Tuple[IncludeChange, int, int]]] = defaultdict(dict)
 
+    # The ignores are checked for every change, so convert them to sets up front
+    if ignores:
+        skip_filenames = frozenset(ignores.skip)
+        ignored_filenames = {
+            IncludeChange.ADD: frozenset(ignores.add.filenames),
+            IncludeChange.REMOVE: frozenset(ignores.remove.filenames),
+        }
+        ignored_headers = {
+            IncludeChange.ADD: frozenset(ignores.add.headers),
+            IncludeChange.REMOVE: frozenset(ignores.remove.headers),
+        }
+        ignored_edges = {
+            IncludeChange.ADD: frozenset(ignores.add.edges),
+            IncludeChange.REMOVE: frozenset(ignores.remove.edges),
+        }
+
     for change_type_value, line, filename, header, *_ in changes:
         change_type = IncludeChange.from_value(change_type_value)
 
@@ -63,28 +79,28 @@ def filter_changes(
         # Cut down on noise by using ignores
         if ignores:
             # Some files have to be skipped because clangd infers a bad compilation command for them
-            if filename in ignores.skip:
+            if filename in skip_filenames:
                 continue
 
             if change_type is IncludeChange.REMOVE:
-                if filename in ignores.remove.filenames:
+                if filename in ignored_filenames[IncludeChange.REMOVE]:
                     logging.info(f"Skipping filename for unused includes: {filename}")
                     continue
 
-                ignore_edge = (filename, header) in ignores.remove.edges
-                ignore_include = header in ignores.remove.headers
+                ignore_edge = (filename, header) in ignored_edges[IncludeChange.REMOVE]
+                ignore_include = header in ignored_headers[IncludeChange.REMOVE]
 
                 # TODO - Ignore unused suggestion if the include is for the associated header
 
                 if ignore_edge or ignore_include:
                     continue
             elif change_type is IncludeChange.ADD:
-                if filename in ignores.add.filenames:
+                if filename in ignored_filenames[IncludeChange.ADD]:
                     logging.info(f"Skipping filename for adding includes: {filename}")
                     continue
 
-                ignore_edge = (filename, header) in ignores.add.edges
-                ignore_include = header in ignores.add.headers
+                ignore_edge = (filename, header) in ignored_edges[IncludeChange.ADD]
+                ignore_include = header in ignored_headers[IncludeChange.ADD]
 
                 if ignore_edge or ignore_include:
                     continue
@@ -126,7 +142,7 @@ def main():
     parser = argparse.ArgumentParser(description="Filter include changes output")
     parser.add_argument(
         "changes_file",
-        type=argparse.FileType("r"),
+        type=argparse.FileType("r", bufsize=1 << 20),
         help="CSV of include changes to filter.",
     )
     parser.add_argument("--filename-filter", help="Regex to filter which files have changes outputted.")
@@ -175,17 +191,18 @@ def main():
     csv_writer = csv.writer(sys.stdout)
 
     try:
-        for change in filter_changes(
-            csv.reader(args.changes_file),
-            ignores=ignores,
-            filename_filter=filename_filter,
-            header_filter=header_filter,
-            change_type_filter=change_type_filter,
-            filter_generated_files=not args.no_filter_generated_files,
-            filter_mojom_headers=not args.no_filter_mojom_headers,
-            header_mappings=config.headerMappings if config else None,
-        ):
-            csv_writer.writerow(change)
+        csv_writer.writerows(
+            filter_changes(
+                csv.reader(args.changes_file),
+                ignores=ignores,
+                filename_filter=filename_filter,
+                header_filter=header_filter,
+                change_type_filter=change_type_filter,
+                filter_generated_files=not args.no_filter_generated_files,
+                filter_mojom_headers=not args.no_filter_mojom_headers,
+                header_mappings=config.headerMappings if config else None,
+            )
+        )
 
         sys.stdout.flush()
     except BrokenPipeError:
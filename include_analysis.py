@@ -1,6 +1,11 @@
+import contextlib
 import json
+import os
+import pathlib
+import pickle
 import re
-from typing import Dict, List, Optional, TypedDict
+import tempfile
+from typing import Dict, List, Optional, TextIO, TypedDict
 
 
 class RawIncludeAnalysisOutput(TypedDict):
@@ -85,3 +90,54 @@ def parse_raw_include_analysis_output(output: str) -> Optional[IncludeAnalysisOu
     parsed_output["prevalence"] = {files[nr]: prevalence for nr, prevalence in enumerate(raw_output["prevalence"])}
 
     return parsed_output
+
+
+def load_include_analysis_output(
+    include_analysis_file: TextIO, cache_dir: Optional[pathlib.Path] = None
+) -> Optional[IncludeAnalysisOutput]:
+    """
+    Loads and parses the include analysis output from a file, using a cache if a cache directory is given
+
+    Parsing the raw output is slow, so the parsed output can be pickled into the cache directory and
+    reused on later runs, as long as the file's path, size, and modification time are unchanged.
+    Loading a pickle can run arbitrary code, so the cache directory must only be writable by trusted users.
+    """
+
+    # Can't cache if the output isn't coming from a regular file, like stdin
+    if cache_dir is None or not os.path.isfile(include_analysis_file.name):
+        return parse_raw_include_analysis_output(include_analysis_file.read())
+
+    path = pathlib.Path(include_analysis_file.name).resolve()
+    stat = os.fstat(include_analysis_file.fileno())
+    cache_key = (str(path), stat.st_size, stat.st_mtime_ns)
+    cache_path = cache_dir / f"{path.name}.pickle"
+
+    try:
+        with open(cache_path, "rb") as cache_file:
+            # As a further precaution, don't load a cache file which belongs to another user
+            if hasattr(os, "getuid") and os.fstat(cache_file.fileno()).st_uid != os.getuid():
+                raise PermissionError(f"Cache file not owned by the current user: {cache_path}")
+
+            # The key is pickled ahead of the parsed output, so a stale cache isn't loaded in full
+            if pickle.load(cache_file) == cache_key:
+                return pickle.load(cache_file)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        pass  # Fall back to parsing the output
+
+    parsed_output = parse_raw_include_analysis_output(include_analysis_file.read())
+
+    # Write to a temporary file first so that a partially written cache is never used
+    temp_file = None
+
+    try:
+        with tempfile.NamedTemporaryFile(dir=cache_dir, prefix=f"{cache_path.name}.", delete=False) as temp_file:
+            pickle.dump(cache_key, temp_file, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(parsed_output, temp_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_file.name, cache_path)
+    except OSError:
+        # Caching is best effort, but don't leave a partially written file behind
+        if temp_file is not None:
+            with contextlib.suppress(OSError):
+                os.unlink(temp_file.name)
+
+    return parsed_output
@@ -4,12 +4,13 @@ import argparse
 import csv
 import logging
 import os
+import pathlib
 import sys
 import typing
 from typing import Dict, Iterator, Optional, Tuple
 
 from common import IncludeChange
-from include_analysis import ParseError, parse_raw_include_analysis_output
+from include_analysis import ParseError, load_include_analysis_output
 from utils import (
     get_include_analysis_edges_centrality,
     get_include_analysis_edge_expanded_sizes,
@@ -58,7 +59,7 @@ def main():
     parser = argparse.ArgumentParser(description="Set edge weights in include changes output")
     parser.add_argument(
         "changes_file",
-        type=argparse.FileType("r"),
+        type=argparse.FileType("r", bufsize=1 << 20),
         help="CSV of include changes to set edge weights for.",
     )
     parser.add_argument(
@@ -73,11 +74,20 @@ def main():
         help="Metric to use for edge weights.",
     )
     parser.add_argument("--config", help="Name of config file to use.")
+    parser.add_argument(
+        "--cache-dir",
+        type=pathlib.Path,
+        help="Directory to cache the parsed include analysis output in, must only be writable by trusted users.",
+    )
     parser.add_argument("--verbose", action="store_true", default=False, help="Enable verbose logging.")
     args = parser.parse_args()
 
+    if args.cache_dir and not args.cache_dir.is_dir():
+        print("error: --cache-dir must be a directory")
+        return 1
+
     try:
-        include_analysis = parse_raw_include_analysis_output(args.include_analysis_output.read())
+        include_analysis = load_include_analysis_output(args.include_analysis_output, args.cache_dir)
     except ParseError as e:
         message = str(e)
         print("error: Could not parse include analysis output file")
@@ -105,8 +115,7 @@ def main():
         edge_weights = get_include_analysis_edge_prevalence(include_analysis, config.includeDirs if config else None)
 
     try:
-        for row in set_edge_weights(args.changes_file, edge_weights):
-            csv_writer.writerow(row)
+        csv_writer.writerows(set_edge_weights(args.changes_file, edge_weights))
 
         sys.stdout.flush()
     except BrokenPipeError:
@@ -11,9 +11,12 @@ from typing import AsyncIterator, Callable, List, Optional, Tuple
 
 from clangd_lsp import ClangdClient, ClangdCrashed
 from common import IncludeChange
-from include_analysis import ParseError, parse_raw_include_analysis_output
+from include_analysis import ParseError, load_include_analysis_output
 from utils import get_worker_count
 
+IGNORED_DIRECTORIES_REGEX = re.compile(r"^(?:buildtools|build|third_party/llvm-build)/")
+IGNORED_EXTENSIONS = (".sigs", ".def", ".gen", ".inc", ".inl", ".s", ".S")
+
 
 def filter_filenames(filenames: List[str], filename_filter: re.Pattern = None) -> List[str]:
     # Filter out some files we know we don't want to process, like the system headers, and non-source files
@@ -21,14 +24,8 @@ def filter_filenames(filenames: List[str], filename_filter: re.Pattern = None) -
     return [
         filename
         for filename in filenames
-        if not re.match(r"^(?:buildtools|build|third_party/llvm-build)/", filename)
-        and not filename.endswith(".sigs")
-        and not filename.endswith(".def")
-        and not filename.endswith(".gen")
-        and not filename.endswith(".inc")
-        and not filename.endswith(".inl")
-        and not filename.endswith(".s")
-        and not filename.endswith(".S")
+        if not filename.endswith(IGNORED_EXTENSIONS)
+        and not IGNORED_DIRECTORIES_REGEX.match(filename)
         and "/usr/include/c++/" not in filename
         and (not filename_filter or (filename_filter and filename_filter.match(filename)))
     ]
@@ -123,9 +120,18 @@ async def main():
     parser.add_argument(
         "--restart-clangd-after", type=int, default=350, help="Restart clangd every N files processed."
     )
+    parser.add_argument(
+        "--cache-dir",
+        type=pathlib.Path,
+        help="Directory to cache the parsed include analysis output in, must only be writable by trusted users.",
+    )
     parser.add_argument("--verbose", action="store_true", default=False, help="Enable verbose logging.")
     args = parser.parse_args()
 
+    if args.cache_dir and not args.cache_dir.is_dir():
+        print("error: --cache-dir must be a directory")
+        return 1
+
     try:
         filename_filter = re.compile(args.filename_filter) if args.filename_filter else None
     except Exception:
@@ -137,7 +143,7 @@ async def main():
         return 1
 
     try:
-        include_analysis = parse_raw_include_analysis_output(args.include_analysis_output.read())
+        include_analysis = load_include_analysis_output(args.include_analysis_output, args.cache_dir)
     except ParseError as e:
         message = str(e)
         print("error: Could not parse include analysis output file")
@@ -1,15 +1,19 @@
+import functools
 import multiprocessing
 import os
 import pathlib
 import re
 from collections import defaultdict
-from typing import DefaultDict, Dict, List
+from typing import DefaultDict, Dict, List, Optional, Tuple
 
 import networkx as nx
 
 from common import Configuration
 from include_analysis import IncludeAnalysisOutput
 
+# Strip off the path prefix for generated file includes so matching will work
+GENERATED_FILE_PREFIX_REGEX = re.compile(r"^(?:out/\w+/gen/)?(.*)$")
+
 
 def get_worker_count():
     try:
@@ -69,29 +73,36 @@ def load_config(name: str):
     return config
 
 
-def get_include_analysis_edge_sizes(include_analysis: IncludeAnalysisOutput, include_directories: List[str] = None):
-    # Strip off the path prefix for generated file includes so matching will work
-    generated_file_prefix = re.compile(r"^(?:out/\w+/gen/)?(.*)$")
+@functools.lru_cache(maxsize=None)
+def get_include_names_for_matching(include: str, include_directories: Tuple[str, ...] = ()) -> Tuple[str, ...]:
+    """
+    Returns the names an include may be referred to by, for matching against include changes
+
+    The same include shows up for every file which includes it, so the result is cached.
+    """
+
+    includes = [include]
+
+    # If an include is in an include directory, strip that prefix and add it for matching
+    for include_directory in include_directories:
+        include_directory = include_directory if include_directory.endswith("/") else f"{include_directory}/"
+        if include.startswith(include_directory):
+            includes.append(include[len(include_directory) :])
 
+    return tuple(GENERATED_FILE_PREFIX_REGEX.match(include).group(1) for include in includes)
+
+
+def get_include_analysis_edge_sizes(include_analysis: IncludeAnalysisOutput, include_directories: List[str] = None):
     edge_sizes = {}
 
-    if include_directories is None:
-        include_directories = []
+    # Convert to a tuple so it can be used in the include names cache key
+    include_dirs: Tuple[str, ...] = tuple(include_directories or ())
 
     for filename in include_analysis["esizes"]:
         edge_sizes[filename] = {}
 
         for include, size in include_analysis["esizes"][filename].items():
-            includes = [include]
-
-            # If an include is in an include directory, strip that prefix and add it to edge sizes for matching
-            for include_directory in include_directories:
-                include_directory = include_directory if include_directory.endswith("/") else f"{include_directory}/"
-                if include.startswith(include_directory):
-                    includes.append(include[len(include_directory) :])
-
-            for include in includes:
-                include = generated_file_prefix.match(include).group(1)
+            for include in get_include_names_for_matching(include, include_dirs):
                 edge_sizes[filename][include] = size
 
     return edge_sizes
@@ -100,28 +111,16 @@ def get_include_analysis_edge_sizes(include_analysis: IncludeAnalysisOutput, inc
 def get_include_analysis_edge_expanded_sizes(
     include_analysis: IncludeAnalysisOutput, include_directories: List[str] = None
 ):
-    # Strip off the path prefix for generated file includes so matching will work
-    generated_file_prefix = re.compile(r"^(?:out/\w+/gen/)?(.*)$")
-
     files = include_analysis["files"]
     root_count = len(include_analysis["roots"])
     edge_expanded_sizes: DefaultDict[str, Dict[str, int]] = defaultdict(dict)
 
-    if include_directories is None:
-        include_directories = []
+    # Convert to a tuple so it can be used in the include names cache key
+    include_dirs: Tuple[str, ...] = tuple(include_directories or ())
 
     for filename in files:
         for include in include_analysis["includes"][filename]:
-            includes = [include]
-
-            # If an include is in an include directory, strip that prefix and add it for matching
-            for include_directory in include_directories:
-                include_directory = include_directory if include_directory.endswith("/") else f"{include_directory}/"
-                if include.startswith(include_directory):
-                    includes.append(include[len(include_directory) :])
-
-            for include in includes:
-                include = generated_file_prefix.match(include).group(1)
+            for include in get_include_names_for_matching(include, include_dirs):
                 edge_expanded_sizes[filename][include] = include_analysis["tsizes"][filename]
 
     return edge_expanded_sizes
@@ -130,28 +129,16 @@ def get_include_analysis_edge_expanded_sizes(
 def get_include_analysis_edge_prevalence(
     include_analysis: IncludeAnalysisOutput, include_directories: List[str] = None
 ):
-    # Strip off the path prefix for generated file includes so matching will work
-    generated_file_prefix = re.compile(r"^(?:out/\w+/gen/)?(.*)$")
-
     files = include_analysis["files"]
     root_count = len(include_analysis["roots"])
     edge_prevalence: DefaultDict[str, Dict[str, float]] = defaultdict(dict)
 
-    if include_directories is None:
-        include_directories = []
+    # Convert to a tuple so it can be used in the include names cache key
+    include_dirs: Tuple[str, ...] = tuple(include_directories or ())
 
     for filename in files:
         for include in include_analysis["includes"][filename]:
-            includes = [include]
-
-            # If an include is in an include directory, strip that prefix and add it for matching
-            for include_directory in include_directories:
-                include_directory = include_directory if include_directory.endswith("/") else f"{include_directory}/"
-                if include.startswith(include_directory):
-                    includes.append(include[len(include_directory) :])
-
-            for include in includes:
-                include = generated_file_prefix.match(include).group(1)
+            for include in get_include_names_for_matching(include, include_dirs):
                 edge_prevalence[filename][include] = (100.0 * include_analysis["prevalence"][filename]) / root_count
 
     return edge_prevalence
@@ -161,33 +148,61 @@ def create_graph_from_include_analysis(include_analysis: IncludeAnalysisOutput):
     DG = nx.DiGraph()
 
     files = include_analysis["files"]
+    file_to_idx = {filename: idx for idx, filename in enumerate(files)}
 
     # Add nodes and edges to the graph
-    # XXX - Unfortunately this is pretty slow, takes several minutes to add the edges
     for idx, filename in enumerate(files):
         DG.add_node(idx, filename=filename)
 
         for include in include_analysis["includes"][filename]:
-            DG.add_edge(idx, files.index(include))
+            DG.add_edge(idx, file_to_idx[include])
 
     return DG
 
 
+def get_include_analysis_degree_centrality(
+    include_analysis: IncludeAnalysisOutput, file_to_idx: Optional[Dict[str, int]] = None
+) -> Tuple[List[float], List[float]]:
+    """
+    Returns the (in-degree, out-degree) centrality of each file, indexed by file number
+
+    Equivalent to running NetworkX's degree centrality on the include graph, but computed
+    directly from the adjacency lists in the include analysis, so the graph is never built.
+    A filename to file number mapping can be passed in if the caller already has one.
+    """
+
+    files = include_analysis["files"]
+
+    if file_to_idx is None:
+        file_to_idx = {filename: idx for idx, filename in enumerate(files)}
+
+    in_degrees = [0] * len(files)
+    out_degrees = [0] * len(files)
+
+    for idx, filename in enumerate(files):
+        # Duplicate includes would be a single edge in a graph, so only count them once
+        included = {file_to_idx[include] for include in include_analysis["includes"][filename]}
+        out_degrees[idx] = len(included)
+
+        for include_idx in included:
+            in_degrees[include_idx] += 1
+
+    scale = 1.0 / (len(files) - 1) if len(files) > 1 else 1.0
+
+    return [degree * scale for degree in in_degrees], [degree * scale for degree in out_degrees]
+
+
 def get_include_analysis_edges_centrality(
     include_analysis: IncludeAnalysisOutput, include_directories: List[str] = None
 ):
-    # Strip off the path prefix for generated file includes so matching will work
-    generated_file_prefix = re.compile(r"^(?:out/\w+/gen/)?(.*)$")
-
-    DG: nx.DiGraph = create_graph_from_include_analysis(include_analysis)
-    nodes_in = nx.in_degree_centrality(DG)
-    nodes_out = nx.out_degree_centrality(DG)
-
     files = include_analysis["files"]
+    file_to_idx = {filename: idx for idx, filename in enumerate(files)}
+    nodes_in, nodes_out = get_include_analysis_degree_centrality(include_analysis, file_to_idx)
+
     edges_centrality: DefaultDict[str, Dict[str, float]] = defaultdict(dict)
 
-    if include_directories is None:
-        include_directories = []
+    # Convert to a tuple so it can be used in the include names cache key
+    include_dirs: Tuple[str, ...] = tuple(include_directories or ())
 
     # Centrality is a metric for a node, but we want to create a metric for an edge.
     # For the moment, this will use a herustic which combines the in-degree centrality
@@ -196,18 +211,8 @@ def get_include_analysis_edges_centrality(
     # edges in commonly included nodes, which pull lots of nodes into the graph.
     for idx, filename in enumerate(files):
         for absolute_include in include_analysis["includes"][filename]:
-            includes = [absolute_include]
-
-            # If an include is in an include directory, strip that prefix and add it for matching
-            for include_directory in include_directories:
-                include_directory = include_directory if include_directory.endswith("/") else f"{include_directory}/"
-                if absolute_include.startswith(include_directory):
-                    includes.append(absolute_include[len(include_directory) :])
-
-            for include in includes:
-                include = generated_file_prefix.match(include).group(1)
-
+            for include in get_include_names_for_matching(absolute_include, include_dirs):
                 # Scale the value up so it's more human-friendly instead of having lots of leading zeroes
-                edges_centrality[filename][include] = 100000 * nodes_out[files.index(absolute_include)] * nodes_in[idx]
+                edges_centrality[filename][include] = 100000 * nodes_out[file_to_idx[absolute_include]] * nodes_in[idx]
 
     return edges_centrality